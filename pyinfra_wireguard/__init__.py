@@ -1 +1 @@
-from .config import deploy_wireguard_child, deploy_wireguard_mother, CONFIG_PATH
+from .config import deploy_wireguard_child, deploy_wireguard_mother, full_config, peer_config, PeerSpec, CONFIG_PATH
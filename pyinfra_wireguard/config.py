@@ -1,9 +1,10 @@
-from io import StringIO
+from dataclasses import dataclass
+from hashlib import sha256
+from io import BytesIO
 
 from pyinfra import host
 from pyinfra.api.deploy import deploy
-from pyinfra.operations import apt, files, systemd
-from pyinfra.facts.files import FindInFile
+from pyinfra.facts.files import FindInFile, Sha256File
 
 from .secrets import generate_private_wg_key_locally, store_public_key_in_pass
 
@@ -11,11 +12,16 @@ from .secrets import generate_private_wg_key_locally, store_public_key_in_pass
 CONFIG_PATH = "/etc/wireguard/wg0.conf"
 
 PEER_CONFIG = """
-# %s
+# {peer}
 [Peer]
-PublicKey = %s
-AllowedIps = %s
+PublicKey = {pubkey}
+AllowedIps = {allowed_ips}
 """
+PEER_CONFIG_WITH_ENDPOINT = PEER_CONFIG + """Endpoint = {endpoint}
+PersistentKeepalive = 25
+"""
+_render_peer = PEER_CONFIG.format
+_render_peer_with_endpoint = PEER_CONFIG_WITH_ENDPOINT.format
 
 
 def peer_config(peer: str, pubkey: str, allowed_ips: str, endpoint="") -> str:
@@ -27,38 +33,128 @@ def peer_config(peer: str, pubkey: str, allowed_ips: str, endpoint="") -> str:
     :param endpoint: (optional) the Endpoint of the peer, must be publically reachable without wireguard
     :return: the config snippet of this specific peer
     """
-    peer_config = PEER_CONFIG % (peer, pubkey, allowed_ips)
     if endpoint:
-        peer_config += f"Endpoint = {endpoint}\nPersistentKeepalive = 25\n"
-    return peer_config
+        return _render_peer_with_endpoint(peer=peer, pubkey=pubkey, allowed_ips=allowed_ips, endpoint=endpoint)
+    return _render_peer(peer=peer, pubkey=pubkey, allowed_ips=allowed_ips)
+
+
+@dataclass(slots=True)
+class PeerSpec:
+    """A wireguard peer, without its PublicKey which is used as the key of the peers dict.
+
+    :param hostname: the hostname of the peer
+    :param allowed_ips: the wireguard-internal AllowedIps
+    :param endpoint: (optional) the Endpoint of the peer, must be publically reachable without wireguard
+    """
+    hostname: str
+    allowed_ips: str
+    endpoint: str = ""
+
+
+def index_peers(peers) -> dict[str, PeerSpec]:
+    """Index peers by their PublicKey, so every peer ends up in the config exactly once.
+
+    :param peers: a dict mapping PublicKeys to PeerSpecs, or a list of (hostname, PublicKey, AllowedIps, Endpoint)
+        tuples; if a PublicKey occurs more than once, the last entry wins
+    :return: a dict mapping the PublicKey of each peer to its PeerSpec
+    """
+    if isinstance(peers, dict):
+        return peers
+    return {pubkey: PeerSpec(hostname, allowed_ips, endpoint) for hostname, pubkey, allowed_ips, endpoint in peers}
 
 
 INTERFACE = """[Interface]
-PrivateKey = %s
-Address = %s
+PrivateKey = {privkey}
+Address = {address}
 """
+_render_interface = INTERFACE.format
 
 
-def full_config(privkey: str, address: str, peers: [tuple], listen_port="") -> str:
+def full_config(privkey: str, address: str, peers: dict[str, PeerSpec], listen_port="") -> bytes:
     """Generate the config file for a wireguard node.
 
     :param privkey: the wireguard Private Key of the child
     :param address: the wireguard-internal IP address of the child
-    :param peers: a list with a tuple for each peer, containing hostname, PublicKey, AllowedIps, and Endpoint
+    :param peers: a dict mapping the PublicKey of each peer to its PeerSpec
     :param listen_port: (optional) the port on which the node listens for peers who want to connect
-    :return: the config to be uploaded
+    :return: the UTF-8 encoded config to be uploaded
     """
-    config = INTERFACE % (privkey, address)
+    parts = [_render_interface(privkey=privkey, address=address)]
     if listen_port:
-        config += f"ListenPort = {listen_port}\n"
-    for peer in peers:
-        peer, pubkey, allowed_ips, endpoint = peer
-        config += peer_config(peer, pubkey, allowed_ips, endpoint)
-    return config
+        parts.append(f"ListenPort = {listen_port}\n")
+    parts.extend(peer_config(p.hostname, pubkey, p.allowed_ips, p.endpoint) for pubkey, p in peers.items())
+    return "".join(parts).encode("utf-8")
+
+
+def install_packages(extra_packages: [str] = ()):
+    """Install wireguard and any extra packages in a single apt transaction.
+
+    :param extra_packages: (optional) additional packages to install alongside wireguard, e.g. qrencode
+    """
+    from pyinfra.operations import apt
+
+    apt.packages(packages=["wireguard", *extra_packages])
+
+
+def get_private_key() -> str:
+    """Read the PrivateKey from the wireguard config on the host.
+
+    :return: the PrivateKey, or an empty string if there is no config yet
+    """
+    lines = host.get_fact(FindInFile, CONFIG_PATH, "PrivateKey = ")
+    if not lines:
+        return ""
+    return lines[0].partition("=")[2].strip()
+
+
+def put_config(config: bytes) -> bool:
+    """Upload the wireguard config, unless the file on the host already has the same SHA-256.
+
+    An existing config is copied to wg0.conf.bak once before it is overwritten.
+
+    :param config: the rendered config, e.g. from full_config
+    :return: whether the config on the host changed
+    """
+    from pyinfra.operations import files, server
+
+    remote_digest = host.get_fact(Sha256File, path=CONFIG_PATH)
+    if sha256(config).hexdigest() == remote_digest:
+        return False
+    if remote_digest:
+        server.shell(
+            name="Back up wireguard config",
+            commands=[f"cp -p {CONFIG_PATH} {CONFIG_PATH}.bak"],
+        )
+    files.put(
+        src=BytesIO(config),
+        dest=CONFIG_PATH,
+        mode="600",
+    )
+    return True
+
+
+def enable_wireguard(reload_config: bool):
+    """Enable and start wg-quick@wg0, and reload it if the config changed.
+
+    The wg-quick unit implements reload with `wg syncconf`, which applies peer changes without dropping existing
+    handshakes.
+
+    :param reload_config: whether the config on the host changed
+    """
+    from pyinfra.operations import systemd
+
+    systemd.service(
+        name="Enable wireguard",
+        service="wg-quick@wg0",
+        enabled=True,
+        running=True,
+        reloaded=reload_config,
+    )
 
 
 @deploy("Deploy WireGuard child")
-def deploy_wireguard_child(address: str, mother: str, m_pubkey: str, m_allowed_ips: str, m_endpoint: str, pass_entry=""):
+def deploy_wireguard_child(address: str, mother: str, m_pubkey: str, m_allowed_ips: str, m_endpoint: str, pass_entry="",
+                           extra_packages: [str] = ()):
     """Deploy wireguard on a child node, configured to connect to a mother node.
 
     :param address: the wireguard-internal IP of the child
@@ -67,66 +163,42 @@ def deploy_wireguard_child(address: str, mother: str, m_pubkey: str, m_allowed_i
     :param m_allowed_ips: the AllowedIps of the mother
     :param m_endpoint: the Endpoint of the mother, must be publically reachable without wireguard
     :param pass_entry: (optional) the pass entry the child's public key should be saved to.
+    :param extra_packages: (optional) additional packages to install in the same apt call as wireguard
     """
-    apt.packages(packages=["wireguard"])
+    install_packages(extra_packages)
 
-    if not host.get_fact(FindInFile, CONFIG_PATH, "PrivateKey = "):
+    privkey = get_private_key()
+    if not privkey:
         privkey, pubkey = generate_private_wg_key_locally()
-        peers = [(mother, m_pubkey, m_allowed_ips, m_endpoint)]
-        files.put(
-            src=StringIO(full_config(privkey, address, peers)),
-            dest=CONFIG_PATH,
-            mode="600",
-        )
         if pass_entry:
             store_public_key_in_pass(pubkey, pass_entry)
 
-    systemd.service(
-        name="Enable wireguard",
-        service="wg-quick@wg0",
-        enabled=True,
-        running=True,
-    )
+    peers = {m_pubkey: PeerSpec(mother, m_allowed_ips, m_endpoint)}
+    reload_config = put_config(full_config(privkey, address, peers))
+
+    enable_wireguard(reload_config)
 
 
 @deploy("Deploy WireGuard mother")
-def deploy_wireguard_mother(address: str, listen_port: str, peers: [tuple], pass_entry=""):
+def deploy_wireguard_mother(address: str, listen_port: str, peers: dict[str, PeerSpec] | list[tuple], pass_entry="",
+                            extra_packages: [str] = ()):
     """Deploy a wireguard mother node
 
     :param address: the wireguard-internal IP of the mother
     :param listen_port: the port on which it listens to children
-    :param peers: a list of tuples for each child, with its hostname, PublicKey, AllowedIps, and Endpoint
+    :param peers: a dict mapping the PublicKey of each child to its PeerSpec, or a list of
+        (hostname, PublicKey, AllowedIps, Endpoint) tuples
     :param pass_entry: (optional) the pass entry the mother's public key should be saved to.
+    :param extra_packages: (optional) additional packages to install in the same apt call as wireguard
     """
-    apt.packages(packages=["wireguard"])
+    install_packages(extra_packages)
 
-    reload_config = False
-    if not host.get_fact(FindInFile, CONFIG_PATH, "PrivateKey = "):
+    privkey = get_private_key()
+    if not privkey:
         privkey, pubkey = generate_private_wg_key_locally()
-        interface = files.put(
-            src=StringIO(full_config(privkey, address, [], listen_port=listen_port)),
-            dest=CONFIG_PATH,
-            mode="600",
-        )
-        reload_config |= interface.changed
         if pass_entry:
             store_public_key_in_pass(pubkey, pass_entry)
 
-    children_config = ""
-    for child in peers:
-        hostname, pubkey, allowed_ips, endpoint = child
-        children_config += peer_config(hostname, pubkey, allowed_ips, endpoint=endpoint)
-
-    peer_added = files.block(
-        path=CONFIG_PATH,
-        content=children_config,
-    )
-    reload_config |= peer_added.changed
+    reload_config = put_config(full_config(privkey, address, index_peers(peers), listen_port=listen_port))
 
-    systemd.service(
-        name="Enable wireguard",
-        service="wg-quick@wg0",
-        enabled=True,
-        running=True,
-        restarted=reload_config,
-    )
+    enable_wireguard(reload_config)
@@ -1,26 +1,40 @@
-from io import StringIO
-from subprocess import Popen, run, PIPE, STDOUT
+from base64 import b64encode
+from functools import lru_cache
+from subprocess import run
 
+try:
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+    from cryptography.hazmat.primitives.serialization import Encoding, NoEncryption, PrivateFormat, PublicFormat
+except ImportError:
+    X25519PrivateKey = None
 
+
+@lru_cache(maxsize=256)
 def get_pass(filename: str) -> str:
-    """Get the data from the password manager."""
+    """Get the data from the password manager, cached for the rest of the run."""
     try:
-        r = run(["pass", "show", filename], capture_output=True)
+        r = run(["pass", "show", filename], capture_output=True, text=True)
     except FileNotFoundError:
         print(f"Please install pass and pull the latest version of our pass secrets")
         exit()
-    return r.stdout.decode('utf-8')
+    return r.stdout
 
 
 def generate_private_wg_key_locally() -> (str, str):
     """Generate a wireguard keypair locally
 
+    Uses the cryptography package if it is installed, and falls back to `wg genkey` otherwise.
+
     :return The private key and the public key as a tuple
     """
+    if X25519PrivateKey is not None:
+        key = X25519PrivateKey.generate()
+        privkey = key.private_bytes(Encoding.Raw, PrivateFormat.Raw, NoEncryption())
+        pubkey = key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+        return b64encode(privkey).decode('utf-8'), b64encode(pubkey).decode('utf-8')
     try:
         privkey = run(["wg", "genkey"], capture_output=True).stdout
-        pipe = Popen(["wg", "pubkey"], stdout=PIPE, stdin=PIPE, stderr=STDOUT)  # , capture_output=True).stdout.decode('utf-8').strip()
-        pubkey = pipe.communicate(input=privkey)[0]
+        pubkey = run(["wg", "pubkey"], input=privkey, capture_output=True).stdout
     except FileNotFoundError:
         print("Can't run `wg genkey`, have you installed wireguard-tools on your local machine?")
         exit(1)
@@ -30,11 +44,14 @@ def generate_private_wg_key_locally() -> (str, str):
 def store_public_key_in_pass(pubkey: str, pass_entry: str):
     """Store the PublicKey of a wireguard node in pass """
     status_quo = get_pass(pass_entry)
-    if pubkey != status_quo:
+    if pubkey != status_quo.strip():
         try:
-            pipe = Popen(["pass", "insert", "-e", pass_entry], stdout=PIPE, stdin=PIPE, stderr=STDOUT)
-            pipe.communicate(input=pubkey.encode('utf-8'))
+            r = run(["pass", "insert", "-e", pass_entry], input=pubkey.encode('utf-8'), capture_output=True)
         except FileNotFoundError:
             print(f"Please install pass and pull the latest version of our pass secrets")
             exit()
+        if r.returncode != 0:
+            print(f"Could not add {pubkey} to {pass_entry}: {r.stderr.decode('utf-8').strip()}")
+            exit(1)
+        get_pass.cache_clear()
         print(f"Added {pubkey} to {pass_entry} - please re-deploy the mother to add the child as a peer.")